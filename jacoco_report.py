@@ -1,10 +1,28 @@
 #!/usr/bin/env python
 import sys
-import xml.etree.ElementTree as ET
+try:
+    # C実装のlxmlがあれば大きなレポートのパースが大幅に高速化される
+    from lxml import etree as ET
+    PARSE_ERROR = ET.XMLSyntaxError
+except ImportError:
+    import xml.etree.ElementTree as ET
+    PARSE_ERROR = ET.ParseError
 import os.path
 import subprocess
-from tabulate import tabulate
 import argparse
+from typing import NamedTuple
+
+
+# パッケージ名をパスに変換するための変換テーブル（毎回のreplaceを避ける）
+DOT2SLASH = str.maketrans('.', '/')
+
+
+class CoverageRow(NamedTuple):
+    """変更ファイル1件分のカバレッジ情報"""
+    file: str
+    line_rate: float
+    branch_rate: float
+    coverage_link: str
 
 
 def parse_arguments():
@@ -55,109 +73,124 @@ def parse_arguments():
     return parser.parse_args()
 
 
-def get_changed_files(base_branch):
-    """指定されたブランチとの差分ファイルを取得"""
-    cmd = ['git', 'diff', '--name-only', base_branch]
+def get_changed_files(base_branch, source_roots):
+    """指定されたブランチとの差分ファイルをソースルート配下に限定して取得"""
+    # -zでNUL区切りにしてファイル名の分割バグを避け、削除済みファイルは除外する
+    # pathspecでソースルート外のファイルはgit側でフィルタする
+    cmd = ['git', 'diff', '--name-only', '--diff-filter=AM', '-z',
+           base_branch, '--'] + list(source_roots)
     result = subprocess.run(cmd, capture_output=True, text=True)
     if result.returncode != 0:
         print(f"Error: Failed to get diff against {base_branch}")
         print(f"Git error: {result.stderr}")
         sys.exit(1)
-    return [f for f in result.stdout.splitlines() if f.endswith('.java')]
-
-
-def get_coverage_from_jacoco(jacoco_xml, source_file):
-    """JaCoCo XMLから直接カバレッジ情報を取得"""
-    tree = ET.parse(jacoco_xml)
-    root = tree.getroot()
-
-    # パッケージ、クラス、ソースファイルを探索
-    for package in root.findall('.//package'):
+    return [f for f in result.stdout.split('\0') if f.endswith('.java')]
+
+
+def counter_rate(elem, counter_type):
+    """指定タイプのカウンターからカバレッジ率を計算"""
+    counter = elem.find(f"counter[@type='{counter_type}']")
+    if counter is None:
+        # 対象カウンターが無い場合（分岐の無いファイル等）はカバー済みとみなす
+        return 1.0
+    covered = int(counter.get('covered', '0'))
+    missed = int(counter.get('missed', '0'))
+    total = covered + missed
+    return covered / total if total else 1.0
+
+
+def build_coverage_index(jacoco_xml, wanted=None):
+    """JaCoCo XMLを一度だけパースしてソースファイル毎のカバレッジ索引を作成
+
+    wantedに対象ファイル名の集合を渡すと、それ以外のソースファイルをスキップする
+    """
+    index = {}
+    # iterparseでパッケージ単位にストリーム処理し、メモリ使用量を抑える
+    for event, package in ET.iterparse(jacoco_xml, events=('end',)):
+        if package.tag != 'package':
+            continue
         for sourcefile in package.findall('sourcefile'):
-            if os.path.basename(source_file) == sourcefile.get('name'):
-                # カウンターからカバレッジを計算
-                counters = sourcefile.findall('counter')
-                line_rate = 0
-                branch_rate = 0
-                for counter in counters:
-                    if counter.get('type') == 'BRANCH':
-                        covered = int(counter.get('covered', 0))
-                        missed = int(counter.get('missed', 0))
-                        total = covered + missed
-                        branch_rate = (covered / total) if total > 0 else 1.0
-                    elif counter.get('type') == 'LINE':
-                        covered = int(counter.get('covered', 0))
-                        missed = int(counter.get('missed', 0))
-                        total = covered + missed
-                        line_rate = (covered / total) if total > 0 else 1.0
-
-                return {
-                    'line_rate': line_rate,
-                    'branch_rate': branch_rate,
-                    'package': package.get('name')
-                }
-
-    return None
+            name = sourcefile.get('name')
+            if wanted is not None and name not in wanted:
+                continue
+            index[name] = {
+                'line_rate': counter_rate(sourcefile, 'LINE'),
+                'branch_rate': counter_rate(sourcefile, 'BRANCH'),
+                'package': package.get('name')
+            }
+        package.clear()
+
+    return index
 
 
 def analyze_coverage(args):
     """カバレッジ分析を実行"""
-    changed_files = get_changed_files(args.base_branch)
+    changed_files = get_changed_files(args.base_branch, args.source_roots)
     if not changed_files:
         print(f"No Java files changed compared to {args.base_branch} branch")
         return
 
+    basenames = {file_path: os.path.basename(file_path)
+                 for file_path in changed_files}
+    try:
+        coverage_index = build_coverage_index(
+            args.jacoco_xml, set(basenames.values()))
+    except (OSError, PARSE_ERROR) as e:
+        print(f"Error: Failed to read JaCoCo report {args.jacoco_xml}")
+        print(f"Reason: {e}")
+        sys.exit(1)
+
     coverage_data = []
-    for file_path in changed_files:
-        try:
-            coverage = get_coverage_from_jacoco(
-                args.jacoco_xml, os.path.basename(file_path))
-            if coverage:
-                coverage_data.append({
-                    'file': file_path,
-                    'line_rate': coverage['line_rate'],
-                    'branch_rate': coverage['branch_rate'],
-                    'coverage_link': os.path.join(
-                        args.jacoco_html_dir,
-                        coverage['package'].replace('.', '/'),
-                        os.path.basename(file_path).replace('.java', '.html')
-                    )
-                })
-        except Exception as e:
-            print(f"Warning: Could not get coverage for {file_path}: {str(e)}",
-                  file=sys.stderr)
+    html_dir = args.jacoco_html_dir
+    for file_path, basename in basenames.items():
+        coverage = coverage_index.get(basename)
+        if coverage:
+            pkg_path = coverage['package'].translate(DOT2SLASH)
+            coverage_data.append(CoverageRow(
+                file=file_path,
+                line_rate=coverage['line_rate'],
+                branch_rate=coverage['branch_rate'],
+                # basenameは必ず.javaで終わるので末尾5文字を付け替えるだけでよい
+                coverage_link=f"{html_dir}/{pkg_path}/{basename[:-5]}.html"
+            ))
 
     display_coverage_results(coverage_data, args)
 
 
 def display_coverage_results(coverage_data, args):
     """カバレッジ結果をテーブル形式で表示"""
+    # 表示時のみ必要なので遅延インポートし、--helpや差分なし時の起動を速くする
+    from tabulate import tabulate
+
     headers = ["File", "Line Coverage", "Branch Coverage", "Coverage Report"]
-    table_data = [
-        [
-            data['file'],
-            f"{data['line_rate']*100:.1f}%",
-            f"{data['branch_rate']*100:.1f}%",
-            data['coverage_link']
-        ] for data in coverage_data
-    ]
+    threshold = args.coverage_threshold
+
+    # テーブル行の作成と閾値判定を1パスで行う
+    table_data = []
+    low_coverage = []
+    for data in coverage_data:
+        line_pct = data.line_rate * 100
+        branch_pct = data.branch_rate * 100
+        table_data.append([
+            data.file,
+            f"{line_pct:.1f}%",
+            f"{branch_pct:.1f}%",
+            data.coverage_link
+        ])
+        if line_pct < threshold or branch_pct < threshold:
+            low_coverage.append((data.file, line_pct, branch_pct))
 
     print(
         f"\nCoverage Report for Changed Files (comparing against {args.base_branch}):")
     print(tabulate(table_data, headers=headers, tablefmt=args.output_format))
 
     # 閾値未満のファイルの警告
-    low_coverage = [d for d in coverage_data if
-                    d['line_rate']*100 < args.coverage_threshold or
-                    d['branch_rate']*100 < args.coverage_threshold]
-
     if low_coverage:
-        print(f"\nWarning: Following files have coverage below {
-              args.coverage_threshold}%:")
-        for data in low_coverage:
-            print(f"- {data['file']}")
-            print(f"  Line Coverage: {data['line_rate']*100:.1f}%")
-            print(f"  Branch Coverage: {data['branch_rate']*100:.1f}%")
+        print(f"\nWarning: Following files have coverage below {threshold}%:")
+        for file_name, line_pct, branch_pct in low_coverage:
+            print(f"- {file_name}")
+            print(f"  Line Coverage: {line_pct:.1f}%")
+            print(f"  Branch Coverage: {branch_pct:.1f}%")
 
 
 def main():